@@ -0,0 +1,494 @@
+"""
+Text extraction and field parsing for Novanta invoice PDFs.
+Kept out of the Streamlit script so worker processes can import it.
+"""
+import functools
+import io
+import re
+
+import pdfplumber
+
+@functools.lru_cache(maxsize=32)
+def _compile(pattern):
+    """
+    Compile a regex once per distinct pattern string.
+    Use this for patterns built at runtime (e.g. from a prefix) so they are not
+    recompiled on every call.
+    """
+    return re.compile(pattern)
+
+# Customer PO numbers start with this prefix
+_CUSTOMER_PO_PREFIX = '450'
+
+# Patterns used while parsing tokens and page text, compiled once at import.
+# An amount glued to an ID within a whitespace-delimited token, e.g. "2.00ABC-123"
+_RE_SPLIT_TOKEN = re.compile(r'(?<!\S)(\d+\.\d+)([A-Za-z0-9\-]+)(?!\S)')
+# Customer PO number, built from _CUSTOMER_PO_PREFIX
+_RE_CUSTPO = _compile(rf'\b({re.escape(_CUSTOMER_PO_PREFIX)}\d+)\b')
+# A blank line, or one reading just "NL", which ends the address block
+_RE_BLOCK_END = re.compile(r'^[^\S\n]*(?:NL[^\S\n]*)?$', re.MULTILINE)
+# Shipped amount in front of a PART ID; used with match(), which anchors at the start
+_RE_PARTID_STRIP = re.compile(r'\d+\.\d+')
+
+# Multi-word headers joined into one token by _normalize_header_line
+_HEADER_PHRASES = ("PACK LIST ID", "PART ID", "SHIPPING METHOD", "SHIP DATE")
+# Any of the headers above standing as whole words, e.g. not the "PART ID" in "COUNTERPART ID"
+_RE_HEADER_PHRASE = re.compile("|".join(
+    r'(?<!\S)' + r'\s+'.join(map(re.escape, header.split())) + r'(?!\S)' for header in _HEADER_PHRASES
+))
+
+def _value_after(text, label, chars=None):
+    """
+    Return the first whitespace-separated token following a literal label, or None.
+    If chars is given, only the token's leading run of those characters is kept,
+    and occurrences of the label not followed by such a run are skipped.
+    Plain string operations stand in for patterns like r'label\s*(\S+)'.
+    """
+    _, sep, rest = text.partition(label)
+    while sep:
+        words = rest.split(None, 1)
+        if not words:
+            return None
+        value = words[0]
+        if chars is not None:
+            value = value[:len(value) - len(value.lstrip(chars))]
+        if value:
+            return value
+        _, sep, rest = rest.partition(label)
+    return None
+
+def _normalize_header_line(line):
+    """
+    Join the words of multi-word headers with underscores ("PACK LIST ID" ->
+    "PACK_LIST_ID") so a plain split() yields one token per header column.
+    Only whole words are joined, so the column positions match a token-by-token merge.
+    """
+    return _RE_HEADER_PHRASE.sub(lambda m: "_".join(m.group().split()), line)
+
+def _is_decimal(token):
+    """
+    Return True for tokens like "25." or "25.0" (digits, a dot, optional digits).
+    """
+    i = token.find('.')
+    return i > 0 and token[:i].isdecimal() and (i == len(token) - 1 or token[i+1:].isdecimal())
+
+def merge_numeric_tokens(tokens):
+    """
+    Merge tokens that appear to be split parts of a number.
+    For example, merge ['25.0', '0'] into ['25.00'].
+    """
+    merged = []
+    i = 0
+    last = len(tokens) - 1
+    while i <= last:
+        token = tokens[i]
+        # Each token is classified once: '.' in token is a C-level pre-check, so
+        # _is_decimal only runs on dotted tokens and isdecimal only on their successor
+        if i < last and '.' in token and _is_decimal(token) and tokens[i+1].isdecimal():
+            merged.append(token + tokens[i+1])
+            i += 2
+        else:
+            merged.append(token)
+            i += 1
+    return merged
+
+def _find_header_start(text, phrase, also=None, start=0):
+    """
+    Return the character offset where the first line containing phrase (and also
+    the string `also`, when given) starts, searching from offset `start`.
+    Returns None if there is no such line.
+    Searches the raw text with str.find instead of testing every line.
+    """
+    while True:
+        pos = text.find(phrase, start)
+        if pos < 0:
+            return None
+        line_start = text.rfind('\n', 0, pos) + 1
+        line_end = text.find('\n', pos)
+        if line_end < 0:
+            line_end = len(text)
+        if also is None or also in text[line_start:line_end]:
+            return line_start
+        start = line_end
+
+# Header lines located on each page: key -> (phrase, other text the same line must contain)
+_PAGE_HEADERS = {
+    'pack': ("PACK LIST ID", None),
+    'part': ("PART ID", "DESCRIPTION"),
+    'shipping': ("SHIPPING METHOD", "SHIP DATE"),
+    'address': ("Bill To Address", "Ship To Address"),
+}
+
+def _find_header_starts(text):
+    """
+    Locate every header in _PAGE_HEADERS on the page in one place.
+    Returns a dict of header key -> offset of the header line for the headers found.
+    """
+    starts = {}
+    for key, (phrase, also) in _PAGE_HEADERS.items():
+        start = _find_header_start(text, phrase, also)
+        if start is not None:
+            starts[key] = start
+    return starts
+
+def _window_lines(text, start, end):
+    """
+    Split only text[start:end] into lines, so the parsers never split the whole page.
+    """
+    return text[start:end].split('\n')
+
+def _lines_end(text, start, count):
+    """
+    Return the offset just past the first `count` lines starting at `start`.
+    """
+    end = start
+    for _ in range(count):
+        end = text.find('\n', end) + 1
+        if end == 0:
+            return len(text)
+    return end
+
+def _parts_table_end(text, start):
+    """
+    Return the offset where the parts table starting at `start` ends: just before
+    the first line after the header that contains "Country MFG:", or the end of the text.
+    """
+    header_end = text.find('\n', start)
+    if header_end < 0:
+        return len(text)
+    pos = text.find("Country MFG:", header_end)
+    if pos < 0:
+        return len(text)
+    return text.rfind('\n', header_end, pos)
+
+def _address_block_end(text, start):
+    """
+    Return the offset where the address block under the header at `start` ends:
+    the first following line that is blank or just "NL", or the end of the text.
+    """
+    header_end = text.find('\n', start)
+    if header_end < 0:
+        return len(text)
+    match = _RE_BLOCK_END.search(text, header_end + 1)
+    return match.start() if match else len(text)
+
+def _parse_parts_table(lines):
+    """
+    Extract parts from a window of lines starting at the parts table header.
+    Returns a list of tuples: (PART ID, DESCRIPTION, Unit Price, Extended Price)
+    """
+    # Collect rows until "Country MFG:" is encountered
+    rows = []
+    for line in lines[1:]:
+        if "Country MFG:" in line:
+            break
+        stripped = line.strip()
+        if not stripped:
+            continue
+        # If the line is purely numeric (e.g., "00003"), append it to the previous row
+        if stripped.isdecimal():
+            if rows:
+                rows[-1] += " " + stripped
+            continue
+        rows.append(stripped)
+
+    parts = []
+    for row in rows:
+        tokens = row.split()
+        if len(tokens) < 3:
+            continue
+        # token[1] holds the shipped amount and PART ID combined;
+        # strip the numeric part to get the actual PART ID.
+        part_token = tokens[1]
+        match = _RE_PARTID_STRIP.match(part_token)
+        part_id = part_token[match.end():] if match else part_token
+        
+        # Extract the description tokens until we hit the first token starting with '$'
+        # Then capture the next two price tokens as Unit Price and Extended Price.
+        rest = tokens[2:]
+        k = next((j for j, t in enumerate(rest) if t.startswith('$')), len(rest))
+        description = " ".join(rest[:k])
+        prices = rest[k:k+2]
+        unit_price = prices[0] if prices else None
+        extended_price = prices[1] if len(prices) > 1 else None
+        parts.append((part_id, description, unit_price, extended_price))
+    return parts
+
+@functools.lru_cache(maxsize=64)
+def _tokenize_data_line(line):
+    """
+    Split a data row into tokens, separating a leading amount glued to an ID
+    (e.g. "2.00ABC-123" -> "2.00", "ABC-123") and re-joining split numbers.
+    Returns a tuple so the cached result cannot be mutated by callers.
+    """
+    fixed_tokens = _RE_SPLIT_TOKEN.sub(r'\1 \2', line).split()
+    return tuple(merge_numeric_tokens(fixed_tokens))
+
+def _parse_pack_row(lines):
+    """
+    Extract PACK LIST ID from a window starting at the header line, followed by its data row.
+    """
+    header_line = lines[0]
+    data_line = lines[1] if len(lines) > 1 else ""
+    header_tokens = _normalize_header_line(header_line).split()
+    # Column position of each header token; the first occurrence wins, as with list.index
+    header_pos = {}
+    for i, tok in enumerate(header_tokens):
+        header_pos.setdefault(tok, i)
+    data_tokens = _tokenize_data_line(data_line)
+    idx = header_pos.get("PACK_LIST_ID")
+    if idx is not None and idx < len(data_tokens):
+        return data_tokens[idx]
+    return None
+
+def _find_pack_list_id(text, start, lines=None):
+    """
+    Extract PACK LIST ID from the header line starting at `start`, moving on to
+    later PACK LIST ID header lines when a header's data row yields nothing.
+    `lines` may hold the header's two-line window if the caller has already split it.
+    """
+    while start is not None:
+        if lines is None:
+            lines = _window_lines(text, start, _lines_end(text, start, 2))
+        pack_list_id = _parse_pack_row(lines)
+        if pack_list_id:
+            return pack_list_id
+        lines = None
+        start = _find_header_start(text, _PAGE_HEADERS['pack'][0], start=_lines_end(text, start, 1))
+    return None
+
+def _parse_shipping_row(lines):
+    """
+    Extract Shipping Method and Ship Date from the shipping info block.
+    Expects a window starting at a header line like:
+    "PACK LIST ID SALES REP ID SHIPPING METHOD SHIP DATE INVOICE DUE DATE"
+    and a data row such as:
+    "182371 INTL UPS WORLDWIDE EXPEDITED COLLECT BLUE 03/28/2024 04/27/2024"
+    """
+    shipping_method = None
+    ship_date = None
+    if len(lines) > 1:
+        data_line = lines[1]
+        data_tokens = data_line.split()
+        # Assuming:
+        # data_tokens[0] = PACK LIST ID
+        # data_tokens[1] = SALES REP ID
+        # data_tokens[2:-2] = SHIPPING METHOD (could be multiple tokens)
+        # data_tokens[-2] = SHIP DATE
+        # data_tokens[-1] = INVOICE DUE DATE
+        if len(data_tokens) >= 5:
+            shipping_method = " ".join(data_tokens[2:-2])
+            ship_date = data_tokens[-2]
+    return shipping_method, ship_date
+
+
+def _parse_ship_to_block(lines):
+    """
+    Extract the Ship To Address from a window starting at the header line
+    "Bill To Address Ship To Address" and the address block under it.
+    Uses a heuristic to split each line into two halves and take the right (ship-to) side.
+    Stops reading once a line equals "NL".
+    """
+    addr_lines = []
+    for line in lines[1:]:
+        tokens = line.split()
+        if not tokens or tokens == ["NL"]:
+            break
+        n = len(tokens)
+        if n % 2 == 0:
+            # Assume ship-to is the second half; the bill-to half is never used.
+            addr_lines.append(" ".join(tokens[n//2:]))
+        else:
+            addr_lines.append(line)
+    return "\n".join(addr_lines)
+
+# One bit per invoice_data field, set by extract_invoice_data once the field is found
+_F_INV, _F_HARM, _F_CPO, _F_PACK, _F_SHIPM, _F_SHIPD, _F_ADDR, _F_PARTS = (1 << i for i in range(8))
+_ALL_SET = (1 << 8) - 1
+# Fields that must be known before trailing pages without new parts are skipped;
+# only the optional Customer PO is left out
+_KEY_FIELDS = _ALL_SET & ~_F_CPO
+
+# Pages in a row without new parts after which the remaining pages are skipped
+_MAX_PAGES_WITHOUT_NEW_PARTS = 2
+
+# Invoices are short; pages beyond this are never read
+_MAX_PAGES = 10
+# Yielded by _iter_page_texts after the last page read when the PDF has more than _MAX_PAGES pages
+_MORE_PAGES = object()
+
+# Pages with fewer characters than this hold no invoice data worth extracting
+_MIN_PAGE_CHARS = 50
+
+# Line boundaries other than "\n" that str.splitlines() also breaks on ("\r\n" is handled first)
+_LINE_BREAKS = str.maketrans(dict.fromkeys('\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029', '\n'))
+
+def _release_page(page):
+    """
+    Drop a page's cached chars/layout objects once its text has been extracted,
+    so memory stays bounded to roughly one page at a time.
+    Uses page.close() on newer pdfplumber versions and flush_cache() otherwise.
+    """
+    close = getattr(page, "close", None)
+    if close is not None:
+        close()
+    else:
+        page.flush_cache()
+
+def _page_text(page):
+    """
+    Return the extracted text of a page, or None if it has fewer than
+    _MIN_PAGE_CHARS characters (blank, scanned or cover pages), so extract_text()'s
+    layout work is skipped for them. The page is released afterwards.
+    Every line boundary is turned into "\n", so the parsers' split('\n') and
+    offset searches see the same lines as str.splitlines() would.
+    """
+    try:
+        if len(page.chars) < _MIN_PAGE_CHARS:
+            return None
+        return page.extract_text().replace('\r\n', '\n').translate(_LINE_BREAKS)
+    finally:
+        _release_page(page)
+
+def _iter_page_texts(pdf_file):
+    """
+    Yield the extracted text of each page in the PDF, in page order.
+    Only the plain text is needed downstream, so pages are released as soon as
+    their text has been extracted.
+    Pages are extracted lazily, so pages after an early stop are never parsed.
+    Only the first _MAX_PAGES pages are read, which bounds the work spent on
+    accidentally large uploads; if the PDF is longer, _MORE_PAGES is yielded last.
+    One page past the cap is opened (but not extracted) to tell whether there is more.
+    """
+    with pdfplumber.open(pdf_file, pages=range(1, _MAX_PAGES + 2)) as pdf:
+        pages = pdf.pages
+        for page in pages[:_MAX_PAGES]:
+            yield _page_text(page)
+        if len(pages) > _MAX_PAGES:
+            yield _MORE_PAGES
+
+def extract_invoice_data(pdf_file):
+    """
+    Extract various fields from the PDF.
+    Returns a dictionary with keys:
+      - Invoice ID
+      - PACK LIST ID
+      - Harmonization Code
+      - Customer PO (starts with 450)
+      - Shipping Method
+      - Ship Date
+      - Ship To Address
+      - PARTS: list of tuples (PART ID, DESCRIPTION, Unit Price, Extended Price)
+      - Pages Skipped: True if pages after the first _MAX_PAGES were needed but not read
+    """
+    invoice_data = {
+        'Invoice ID': None,
+        'PACK LIST ID': None,
+        'Harmonization Code': None,
+        'Customer PO': None,
+        'Shipping Method': None,
+        'Ship Date': None,
+        'Ship To Address': None,
+        'PARTS': [],  # List of tuples: (PART ID, DESCRIPTION, Unit Price, Extended Price)
+        'Pages Skipped': False,
+    }
+    
+    found = 0  # _F_* bits of the fields found so far
+    pages_without_new_parts = 0
+    for text in _iter_page_texts(pdf_file):
+        if text is _MORE_PAGES:
+            invoice_data['Pages Skipped'] = True
+            break
+        if not text:
+            continue
+        parts_before = len(invoice_data['PARTS'])
+        
+        # Invoice ID
+        if not found & _F_INV:
+            invoice_data['Invoice ID'] = _value_after(text, 'Invoice ID:')
+            if invoice_data['Invoice ID']:
+                found |= _F_INV
+        
+        # Harmonization Code
+        if not found & _F_HARM:
+            invoice_data['Harmonization Code'] = _value_after(text, 'Harmonization Code:', '0123456789.')
+            if invoice_data['Harmonization Code']:
+                found |= _F_HARM
+        
+        # Customer PO (starts with _CUSTOMER_PO_PREFIX); the substring check skips the regex on pages without one
+        if not found & _F_CPO and _CUSTOMER_PO_PREFIX in text:
+            match = _RE_CUSTPO.search(text)
+            if match:
+                invoice_data['Customer PO'] = match.group(1)
+                found |= _F_CPO
+        
+        # Locate all header lines once; each parser then splits only the lines it reads
+        header_starts = _find_header_starts(text)
+        # The pack list and shipping headers are usually the same line; split its window once
+        shared_row = None
+        if 'shipping' in header_starts and header_starts['shipping'] == header_starts.get('pack'):
+            start = header_starts['shipping']
+            shared_row = _window_lines(text, start, _lines_end(text, start, 2))
+        
+        # PACK LIST ID
+        if 'pack' in header_starts and not found & _F_PACK:
+            pack_list_id = _find_pack_list_id(text, header_starts['pack'], shared_row)
+            if pack_list_id:
+                invoice_data['PACK LIST ID'] = pack_list_id
+                found |= _F_PACK
+
+        # Parts table (including Unit Price and Extended Price)
+        if 'part' in header_starts:
+            start = header_starts['part']
+            parts = _parse_parts_table(_window_lines(text, start, _parts_table_end(text, start)))
+            if parts:
+                invoice_data['PARTS'].extend(parts)
+                found |= _F_PARTS
+        
+        # Shipping info: Shipping Method and Ship Date
+        if 'shipping' in header_starts:
+            start = header_starts['shipping']
+            lines = shared_row if shared_row is not None else _window_lines(text, start, _lines_end(text, start, 2))
+            shipping_method, ship_date = _parse_shipping_row(lines)
+            if shipping_method and not found & _F_SHIPM:
+                invoice_data['Shipping Method'] = shipping_method
+                found |= _F_SHIPM
+            if ship_date and not found & _F_SHIPD:
+                invoice_data['Ship Date'] = ship_date
+                found |= _F_SHIPD
+        
+        # Ship To Address
+        if 'address' in header_starts and not found & _F_ADDR:
+            start = header_starts['address']
+            ship_to = _parse_ship_to_block(_window_lines(text, start, _address_block_end(text, start)))
+            if ship_to:
+                invoice_data['Ship To Address'] = ship_to
+                found |= _F_ADDR
+        
+        # Optionally break early if all fields are found
+        if found == _ALL_SET:
+            break
+        
+        # Also stop once the key header fields are known and the parts table
+        # has not grown for a couple of consecutive pages (trailing T&C pages etc.)
+        if len(invoice_data['PARTS']) == parts_before:
+            pages_without_new_parts += 1
+        else:
+            pages_without_new_parts = 0
+        if (pages_without_new_parts >= _MAX_PAGES_WITHOUT_NEW_PARTS and
+            found & _KEY_FIELDS == _KEY_FIELDS):
+            break
+    
+    return invoice_data
+
+def _extract_from_bytes(payload):
+    """
+    Parse one (filename, pdf_bytes) upload.
+    Returns (invoice data, None) on success or (None, error message) on failure, so
+    one bad file does not abort the rest of the batch.
+    """
+    _, pdf_bytes = payload
+    try:
+        return extract_invoice_data(io.BytesIO(pdf_bytes)), None
+    except Exception as e:
+        return None, str(e)